@@ -1,49 +1,235 @@
 #!/usr/bin/env python3
 import os
+import atexit
+import hashlib
+import hmac
+import json
 import logging
+import logging.handlers
+import queue
+import re
+import threading
 import time
 import git
 import subprocess
 import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
+# Configure logging; records go through an in-memory queue so the
+# update loop never blocks on disk writes
+log_queue = queue.Queue(-1)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('/var/log/gfp-pckmgr-updater.log')
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.StreamHandler(),
+    logging.FileHandler('/var/log/gfp-pckmgr-updater.log')
+)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Configuration
 REPO_PATH = '/opt/gfp-pckmgr'
 REMOTE_URL = 'https://github.com/GFPC/GFP-PCKMGR.git'
-CHECK_INTERVAL = 5  # 5 seconds between checks
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '5'))  # Seconds between checks
+MAX_POLL_INTERVAL = 300  # Upper bound for the idle backoff
+BACKUP_RETENTION_DAYS = 7  # Backups older than this are pruned
 GIT_FETCH_INTERVAL = 30  # 30 seconds between git fetches
+FALLBACK_POLL_INTERVAL = 3600  # Safety-net poll when the webhook is active
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '0'))  # 0 disables the webhook listener
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+LAST_REMOTE_SHA_FILE = os.path.join(REPO_PATH, '.last_remote_sha')
 last_fetch_time = 0
+last_remote_sha = None
+cached_branch = None
+
+# Event used to wake the main loop as soon as a push webhook arrives
+update_event = threading.Event()
+
+# Matches the symbolic-ref line of 'git ls-remote --symref origin HEAD'
+HEAD_BRANCH_RE = re.compile(r'ref:\s+refs/heads/(\S+)\s+HEAD')
+
+
+def get_remote_default_branch(repo):
+    """Resolve the remote's default branch from its HEAD symref."""
+    try:
+        output = repo.git.ls_remote('--symref', 'origin', 'HEAD')
+        match = HEAD_BRANCH_RE.search(output)
+        if match:
+            return match.group(1)
+    except Exception as e:
+        logger.error("Failed to resolve remote default branch: %s", e)
+    return None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receive GitHub push webhooks and wake the update loop."""
+
+    def do_POST(self):
+        if self.path != '/webhook':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        # Verify the payload signature against WEBHOOK_SECRET
+        signature = self.headers.get('X-Hub-Signature-256', '')
+        expected = 'sha256=' + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            logger.warning("Webhook request with invalid signature rejected")
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Only push events for a branch head should trigger a check
+        if self.headers.get('X-GitHub-Event') == 'push' and str(payload.get('ref', '')).startswith('refs/heads/'):
+            logger.info("Push webhook received for %s, scheduling update check", payload.get('ref'))
+            # Reset the ls-remote throttle so the woken cycle really asks
+            # the remote; otherwise a push within GIT_FETCH_INTERVAL of
+            # the previous check would reuse the pre-push SHA and sleep
+            # a full fallback interval
+            global last_fetch_time
+            last_fetch_time = 0
+            update_event.set()
+
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook server: %s", format % args)
+
+
+def start_webhook_server():
+    """Start the webhook listener in a background thread if configured."""
+    if not WEBHOOK_PORT:
+        return None
+
+    if not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_PORT is set but WEBHOOK_SECRET is missing, webhook disabled")
+        return None
+
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', WEBHOOK_PORT), WebhookHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        logger.info("Webhook server listening on 127.0.0.1:%s", WEBHOOK_PORT)
+        return server
+    except Exception as e:
+        logger.error("Failed to start webhook server: %s", e)
+        return None
+
+
+def load_last_remote_sha():
+    """Load the last-known remote SHA persisted by a previous run."""
+    try:
+        with open(LAST_REMOTE_SHA_FILE, 'r') as f:
+            sha = f.read().strip()
+            return sha or None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error("Failed to load last remote SHA: %s", e)
+        return None
+
+
+def save_last_remote_sha(sha):
+    """Persist the last-known remote SHA so restarts skip the initial check."""
+    try:
+        tmp_file = LAST_REMOTE_SHA_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(sha)
+        os.replace(tmp_file, LAST_REMOTE_SHA_FILE)
+    except Exception as e:
+        logger.error("Failed to save last remote SHA: %s", e)
+
+
+def prune_old_backups(backup_dir):
+    """Remove backups older than BACKUP_RETENTION_DAYS to bound growth."""
+    cutoff = time.time() - BACKUP_RETENTION_DAYS * 86400
+    try:
+        for entry in os.listdir(backup_dir):
+            # Age by the creation epoch in the .bak.<timestamp> suffix:
+            # hardlinks and copy2 both preserve the source's mtime, so a
+            # fresh backup of an old file would look old on disk. The
+            # .sha1 sidecars carry dedup state and are never pruned.
+            _, _, suffix = entry.rpartition('.bak.')
+            if not suffix.isdigit():
+                continue
+            path = os.path.join(backup_dir, entry)
+            if os.path.isfile(path) and int(suffix) < cutoff:
+                os.unlink(path)
+                logger.info("Pruned old backup %s", path)
+    except Exception as e:
+        logger.error("Backup pruning failed: %s", e)
 
 
-def backup_local_files():
+def managed_files_dirty(repo):
+    """Check whether the managed .py files have local modifications."""
+    try:
+        return bool(repo.git.diff('--name-only', '--', 'check_updates.py', 'gfp_pckmgr.py'))
+    except Exception as e:
+        logger.error("Dirty check failed: %s", e)
+        return True  # Assume dirty so the backup still happens
+
+
+def backup_local_files(repo=None):
     """Backup locally modified files before overwriting them."""
     try:
+        # Nothing locally modified means there is nothing to preserve
+        if repo is not None and not managed_files_dirty(repo):
+            logger.debug("Managed files unchanged, skipping backup")
+            return True
+
         backup_dir = os.path.join(REPO_PATH, 'backup')
         os.makedirs(backup_dir, exist_ok=True)
 
         for file in ['check_updates.py', 'gfp_pckmgr.py']:
             src = os.path.join(REPO_PATH, file)
             if os.path.exists(src):
+                with open(src, 'rb') as f:
+                    src_hash = hashlib.sha1(f.read()).hexdigest()
+
+                # Skip files identical to their most recent backup
+                sidecar = os.path.join(backup_dir, f"{file}.sha1")
+                try:
+                    with open(sidecar, 'r') as f:
+                        if f.read().strip() == src_hash:
+                            logger.debug("%s unchanged since last backup, skipping", file)
+                            continue
+                except FileNotFoundError:
+                    pass
+
                 dst = os.path.join(backup_dir, f"{file}.bak.{int(time.time())}")
-                shutil.copy2(src, dst)
-                logger.info(f"Backed up {file} to {dst}")
+                try:
+                    # Hardlink snapshot: same inode, no content copy
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+                with open(sidecar, 'w') as f:
+                    f.write(src_hash)
+                logger.info("Backed up %s to %s", file, dst)
+
+        prune_old_backups(backup_dir)
         return True
     except Exception as e:
-        logger.error(f"Backup failed: {str(e)}")
+        logger.error("Backup failed: %s", e)
         return False
 
 
@@ -58,7 +244,7 @@ def setup_git_repo():
             logger.info("Using existing repository")
 
             # Backup local changes before any operations
-            if not backup_local_files():
+            if not backup_local_files(repo):
                 logger.warning("Failed to backup files, continuing anyway")
 
             # Reset any local changes
@@ -79,32 +265,36 @@ def setup_git_repo():
             # Determine active branch
             try:
                 branch = repo.active_branch.name
-                logger.info(f"Current active branch: {branch}")
+                logger.info("Current active branch: %s", branch)
             except:
                 branch = 'main'  # Default fallback
-                logger.info(f"No active branch detected, using default: {branch}")
+                logger.info("No active branch detected, using default: %s", branch)
 
             # Verify branch exists
             if f'origin/{branch}' not in repo.references:
-                logger.warning(f"Branch origin/{branch} not found, searching for available branches")
+                logger.warning("Branch origin/%s not found, searching for available branches", branch)
                 available_branches = []
                 for ref in repo.references:
                     if ref.name.startswith('origin/'):
                         available_branches.append(ref.name.split('/')[-1])
                 
-                if available_branches:
+                default_branch = get_remote_default_branch(repo)
+                if default_branch and default_branch in available_branches:
+                    branch = default_branch
+                    logger.info("Using remote default branch: %s", branch)
+                elif available_branches:
                     branch = available_branches[0]
-                    logger.info(f"Found available branches: {available_branches}, using {branch}")
+                    logger.info("Found available branches: %s, using %s", available_branches, branch)
                 else:
                     raise Exception("No remote branches found")
 
             # Reset to remote branch
-            logger.info(f"Resetting to origin/{branch}")
+            logger.info("Resetting to origin/%s", branch)
             repo.git.reset('--hard', f'origin/{branch}')
 
             # Ensure we're on the correct branch
             if branch != repo.active_branch.name:
-                logger.info(f"Switching to branch {branch}")
+                logger.info("Switching to branch %s", branch)
                 repo.git.checkout(branch)
 
         except git.exc.InvalidGitRepositoryError:
@@ -123,9 +313,13 @@ def setup_git_repo():
                 if ref.name.startswith('origin/'):
                     available_branches.append(ref.name.split('/')[-1])
             
-            if available_branches:
+            default_branch = get_remote_default_branch(repo)
+            if default_branch and default_branch in available_branches:
+                branch = default_branch
+                logger.info("Using remote default branch: %s", branch)
+            elif available_branches:
                 branch = available_branches[0]
-                logger.info(f"Found available branches: {available_branches}, using {branch}")
+                logger.info("Found available branches: %s, using %s", available_branches, branch)
             else:
                 logger.warning("No remote branches found, using default 'main'")
 
@@ -135,48 +329,90 @@ def setup_git_repo():
             repo.heads[branch].checkout()
             repo.git.reset('--hard', f'origin/{branch}')
 
-        # Configure git user
-        with repo.config_writer() as git_config:
-            if not git_config.has_option('user', 'name'):
-                git_config.set_value('user', 'name', 'GFP Package Manager')
-            if not git_config.has_option('user', 'email'):
-                git_config.set_value('user', 'email', 'bot@gfp-pckmgr')
-
-        logger.info(f"Repository ready. Branch: {repo.active_branch.name}")
+        # Configure git user; only open the writer (which rewrites
+        # .git/config) when something is actually missing
+        with repo.config_reader() as git_config:
+            needs_name = not git_config.has_option('user', 'name')
+            needs_email = not git_config.has_option('user', 'email')
+            needs_http2 = git_config.get_value('http', 'version', '') != 'HTTP/2'
+            needs_untracked_cache = not git_config.get_value('core', 'untrackedCache', False)
+
+        if needs_name or needs_email or needs_http2 or needs_untracked_cache:
+            with repo.config_writer() as git_config:
+                if needs_name:
+                    git_config.set_value('user', 'name', 'GFP Package Manager')
+                if needs_email:
+                    git_config.set_value('user', 'email', 'bot@gfp-pckmgr')
+                if needs_http2:
+                    # Let ls-remote/fetch reuse a multiplexed HTTP/2 connection
+                    git_config.set_value('http', 'version', 'HTTP/2')
+                if needs_untracked_cache:
+                    # Speeds up the untracked-file scans done by status/clean
+                    git_config.set_value('core', 'untrackedCache', 'true')
+
+        logger.info("Repository ready. Branch: %s", repo.active_branch.name)
         return repo
 
     except Exception as e:
-        logger.error(f"Repository setup failed: {str(e)}")
+        logger.error("Repository setup failed: %s", e)
         raise
 
 
-def check_updates(repo):
+def check_updates(repo, origin):
     """Check for and apply updates."""
     try:
-        global last_fetch_time
+        global last_fetch_time, last_remote_sha, cached_branch
         current_time = time.time()
-        
-        # Get current state
-        try:
-            branch = repo.active_branch.name
-        except:
-            branch = 'main'  # Default fallback
 
+        # Get current state, reusing the branch resolved on a previous cycle
+        if cached_branch:
+            branch = cached_branch
+        else:
+            try:
+                branch = repo.active_branch.name
+            except:
+                branch = 'main'  # Default fallback
+            cached_branch = branch
+
+        # Bind the head SHA once; every later comparison reuses the local
         current_commit = repo.head.commit
-        logger.info(f"Current local commit: {current_commit.hexsha[:7]}")
+        current_sha = current_commit.hexsha
+        logger.info("Current local commit: %s", current_sha[:7])
 
-        # Only fetch from remote if enough time has passed
+        # Ask the remote for its branch tip only if enough time has passed;
+        # ls-remote transfers just the SHA instead of a full pack
         if current_time - last_fetch_time >= GIT_FETCH_INTERVAL:
-            logger.info("Fetching updates from remote...")
-            repo.remotes.origin.fetch(prune=True, force=True)
+            logger.debug("Checking remote HEAD via ls-remote...")
+            ls_output = repo.git.ls_remote('origin', f'refs/heads/{branch}')
             last_fetch_time = current_time
-            logger.info("Fetch completed")
+            if ls_output:
+                last_remote_sha = ls_output.split()[0]
+                save_last_remote_sha(last_remote_sha)
         else:
-            logger.debug("Skipping fetch, rate limit not reached")
+            logger.debug("Skipping remote check, rate limit not reached")
+
+        # Nothing new on the remote, skip the fetch entirely
+        if last_remote_sha is None or last_remote_sha == current_sha:
+            logger.debug("No updates available")
+            return False
+
+        # If a previous cycle already fetched this exact tip, the update
+        # is just waiting for user confirmation - don't re-fetch and
+        # rewrite the notification every cycle until then
+        if f'origin/{branch}' in repo.references and origin.refs[branch].commit.hexsha == last_remote_sha:
+            logger.debug("Update to %s already fetched and announced, awaiting confirmation", last_remote_sha[:7])
+            return False
+
+        # The remote moved, now do the real fetch to get the objects.
+        # Only the tip commit is ever needed for reset --hard, so a
+        # shallow fetch keeps the transferred pack minimal
+        logger.info("Remote HEAD changed, fetching updates...")
+        repo.git.fetch('origin', branch, depth=1, prune=True, force=True)
+        logger.info("Fetch completed")
 
         # Verify branch exists
         if f'origin/{branch}' not in repo.references:
-            logger.warning(f"Branch origin/{branch} not found, searching for available branches")
+            logger.warning("Branch origin/%s not found, searching for available branches", branch)
             available_branches = []
             for ref in repo.references:
                 if ref.name.startswith('origin/'):
@@ -184,27 +420,28 @@ def check_updates(repo):
             
             if available_branches:
                 branch = available_branches[0]
-                logger.info(f"Found available branches: {available_branches}, using {branch}")
+                cached_branch = branch
+                logger.info("Found available branches: %s, using %s", available_branches, branch)
             else:
                 raise Exception("No remote branches found")
 
         # Get remote commit
-        remote_commit = repo.remotes.origin.refs[branch].commit
-        logger.info(f"Remote commit: {remote_commit.hexsha[:7]}")
+        remote_commit = origin.refs[branch].commit
+        logger.info("Remote commit: %s", remote_commit.hexsha[:7])
 
         # Check if update needed
-        if current_commit.hexsha == remote_commit.hexsha:
+        if current_sha == remote_commit.hexsha:
             logger.debug("No updates available")
             return False
 
         # Apply updates
-        logger.info(f"Update available! Local: {current_commit.hexsha[:7]}, Remote: {remote_commit.hexsha[:7]}")
+        logger.info("Update available! Local: %s, Remote: %s", current_sha[:7], remote_commit.hexsha[:7])
         commit_message = remote_commit.message.splitlines()[0]
-        logger.info(f"Commit message: {commit_message}")
+        logger.info("Commit message: %s", commit_message)
 
         # Create update notification file
         update_info = {
-            'old_commit': current_commit.hexsha,
+            'old_commit': current_sha,
             'new_commit': remote_commit.hexsha,
             'branch': branch,
             'message': commit_message,
@@ -213,20 +450,24 @@ def check_updates(repo):
         }
         
         update_file = os.path.join(REPO_PATH, '.update_available')
-        logger.info(f"Creating update notification file at {update_file}")
-        logger.info(f"Update info: {update_info}")
+        logger.info("Creating update notification file at %s", update_file)
+        logger.info("Update info: %s", update_info)
         
         try:
-            with open(update_file, 'w') as f:
-                f.write(str(update_info))
+            # Write JSON via a temp file and atomic rename so readers
+            # never observe a half-written notification
+            tmp_file = update_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(update_info, f)
+            os.replace(tmp_file, update_file)
             logger.info("Update notification file created successfully")
         except Exception as e:
-            logger.error(f"Failed to create update notification file: {str(e)}")
+            logger.error("Failed to create update notification file: %s", e)
 
         return True
 
     except Exception as e:
-        logger.error(f"Update check failed: {str(e)}")
+        logger.error("Update check failed: %s", e)
         raise
 
 
@@ -237,19 +478,48 @@ def main():
     try:
         repo = setup_git_repo()
 
+        # Resolve the origin handle once for the process lifetime instead
+        # of re-reading .git/config on every cycle
+        origin = repo.remotes.origin
+
+        # Reuse the remote SHA from the previous run so a service restart
+        # does not immediately hit the network again
+        global last_remote_sha
+        last_remote_sha = load_last_remote_sha()
+        if last_remote_sha:
+            logger.info("Loaded last known remote SHA: %s", last_remote_sha[:7])
+
+        # With a webhook configured, polling is only a safety net
+        webhook_server = start_webhook_server()
+        idle_checks = 0
+
         while True:
             try:
-                check_updates(repo)
+                updated = check_updates(repo, origin)
             except Exception as e:
-                logger.error(f"Update cycle failed: {str(e)}")
+                logger.error("Update cycle failed: %s", e)
+                updated = False
+
+            # Back off the poll while the remote is idle; the first
+            # detected change snaps the interval back to the base rate
+            if updated:
+                idle_checks = 0
+            else:
+                idle_checks += 1
+
+            if webhook_server:
+                poll_interval = FALLBACK_POLL_INTERVAL
+            else:
+                poll_interval = min(CHECK_INTERVAL * (2 ** min(idle_checks, 8)), MAX_POLL_INTERVAL)
 
-            # Sleep for CHECK_INTERVAL seconds
-            time.sleep(CHECK_INTERVAL)
+            # Wait until the next poll, waking early on a webhook event
+            update_event.wait(timeout=poll_interval)
+            update_event.clear()
 
     except KeyboardInterrupt:
         logger.info("Service stopped by user")
     except Exception as e:
-        logger.error(f"Fatal error: {str(e)}")
+        logger.error("Fatal error: %s", e)
         raise
 
 
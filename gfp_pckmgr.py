@@ -1,33 +1,48 @@
 #!/usr/bin/env python3
 import os
+import asyncio
+import atexit
+import fcntl
+import functools
+import io
+import json
 import logging
-import subprocess
-import tempfile
+import logging.handlers
+import queue
+import sys
 import time
 import git
 import hashlib
 import shutil
+import stat
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.ext import Application, AIORateLimiter, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
+# Configure logging; records go through an in-memory queue so handler
+# coroutines never block the event loop on disk writes
+log_queue = queue.Queue(-1)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('/var/log/gfp-pckmgr.log')
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.StreamHandler(),
+    logging.FileHandler('/var/log/gfp-pckmgr.log')
+)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Get configuration from environment variables
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-ALLOWED_USERS = [int(user_id) for user_id in os.getenv('ALLOWED_USERS', '').split(',') if user_id]
+ALLOWED_USERS = frozenset(int(user_id) for user_id in os.getenv('ALLOWED_USERS', '').split(',') if user_id)
 
 if not BOT_TOKEN:
     logger.error("BOT_TOKEN not found in environment variables")
@@ -39,9 +54,6 @@ if not ALLOWED_USERS:
 
 logger.info("Bot configuration loaded successfully")
 
-# Dictionary to store command mode status for each user
-command_mode_users = set()
-
 HELP_MESSAGE = """
 🤖 *GFP Package Manager Bot Help*
 
@@ -102,12 +114,93 @@ UNKNOWN_COMMAND_MESSAGE = """
 /version - Show version info
 """
 
+# Built once at import so the auth-fail fast path allocates nothing
+_UNAUTH = "You are not authorized to use this bot."
+
+# Files that require a service restart when an update changes them
+RESTART_FILES = frozenset({
+    'gfp_pckmgr.py',
+    'check_updates.py',
+    'requirements.txt',
+    'gfp-pckmgr.service',
+    'gfp-pckmgr-updater.service',
+})
+
+UPDATE_NOTIFICATION_TEMPLATE = (
+    "🔄 *New Update Available!*\n\n"
+    "*Commit:* {message}\n"
+    "*Author:* {author}\n"
+    "*Date:* {date}\n"
+    "*Branch:* {branch}\n"
+    "*Old Commit:* {old_commit}\n"
+    "*New Commit:* {new_commit}\n\n"
+    "Would you like to update now?"
+)
+
+# The update keyboards never change, so build them once at import
+UPDATE_CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Update Now", callback_data="update_confirm")],
+    [InlineKeyboardButton("❌ Cancel Update", callback_data="update_cancel")]
+])
+
+UPDATE_ONLY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Update Now", callback_data="update_confirm")]
+])
+
+REPO_PATH = '/opt/gfp-pckmgr'
+UPDATE_FILE = os.path.join(REPO_PATH, '.update_available')
+
+# Shared repo handle and fetch throttle; constructing git.Repo and
+# fetching both spawn git subprocesses, so handlers reuse one of each
+_repo = None
+_last_fetch = 0.0
+
+def _get_repo():
+    """Return the shared repository handle, creating it on first use."""
+    global _repo
+    if _repo is None:
+        _repo = git.Repo(REPO_PATH)
+    return _repo
+
+async def _fetch_if_stale(repo, ttl=60, force=False):
+    """Fetch origin off the event loop, at most once per ttl seconds."""
+    global _last_fetch
+    now = time.monotonic()
+    if force or now - _last_fetch > ttl:
+        await asyncio.to_thread(repo.remotes.origin.fetch)
+        _last_fetch = now
+
+# File-hash cache for /version: path -> (mtime_ns, size, md5 hexdigest)
+_hash_cache = {}
+
+def _file_md5(file_path):
+    """Return the MD5 of a file, recomputing only when it changes on disk."""
+    st = os.stat(file_path)
+    cached = _hash_cache.get(file_path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+    _hash_cache[file_path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+def authorized(handler):
+    """Reject updates from users outside ALLOWED_USERS before dispatching."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ALLOWED_USERS:
+            await update.message.reply_text(_UNAUTH)
+            return
+        await handler(update, context)
+    return wrapper
+
+@authorized
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text(
         "Hello! I'm GFP Package Manager bot.\n\n"
         "Available commands:\n"
@@ -119,20 +212,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/load_journal <service_name> <lines_num> - Get service logs"
     )
 
+@authorized
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text(HELP_MESSAGE, parse_mode='Markdown')
 
+@authorized
 async def load_journal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get service logs using journalctl."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     if len(context.args) != 2:
         await update.message.reply_text(
             "Please provide service name and number of lines.\n"
@@ -150,46 +237,34 @@ async def load_journal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.log', delete=False) as temp_file:
-            # Run journalctl command and write output to temp file
-            result = subprocess.run(
-                f"journalctl -eu {service_name} -n {lines_num}",
-                shell=True,
-                capture_output=True,
-                text=True
+        # Run journalctl directly (no shell) without blocking the event loop
+        proc = await asyncio.create_subprocess_exec(
+            'journalctl', '-eu', service_name, '-n', str(lines_num),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await proc.communicate()
+
+        if proc.returncode != 0:
+            await update.message.reply_text(
+                f"❌ Error getting logs for {service_name}:\n{stderr.decode(errors='replace')}"
             )
-            
-            if result.returncode != 0:
-                await update.message.reply_text(
-                    f"❌ Error getting logs for {service_name}:\n{result.stderr}"
-                )
-                return
-            
-            # Write logs to temp file
-            temp_file.write(result.stdout)
-            temp_file.flush()
-            
-            # Send the file
-            with open(temp_file.name, 'rb') as file:
-                await update.message.reply_document(
-                    document=file,
-                    filename=f"{service_name}_logs.log",
-                    caption=f"Logs for {service_name} (last {lines_num} lines)"
-                )
-            
-            # Clean up
-            os.unlink(temp_file.name)
-            
+            return
+
+        # Upload straight from memory instead of a temp-file round-trip
+        log_buffer = io.BytesIO(stdout)
+        await update.message.reply_document(
+            document=log_buffer,
+            filename=f"{service_name}_logs.log",
+            caption=f"Logs for {service_name} (last {lines_num} lines)"
+        )
+
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
+@authorized
 async def execute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Execute a command on the system."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     if not context.args:
         await update.message.reply_text("Please provide a command to execute.")
         return
@@ -197,163 +272,172 @@ async def execute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     command = ' '.join(context.args)
     await _execute_and_reply(update, context, command)
 
+@authorized
 async def cmd_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enter command mode."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
-    user_id = update.effective_user.id
-    command_mode_users.add(user_id)
+    context.user_data['cmd_mode'] = True
     await update.message.reply_text(
         "Entered command mode. Send commands directly without /exec.\n"
         "Type 'exit' or use /exit to leave command mode."
     )
 
+@authorized
 async def exit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Exit command mode."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
-    user_id = update.effective_user.id
-    if user_id in command_mode_users:
-        command_mode_users.remove(user_id)
+    if context.user_data.get('cmd_mode'):
+        context.user_data['cmd_mode'] = False
         await update.message.reply_text("Exited command mode.")
     else:
         await update.message.reply_text("You are not in command mode.")
 
+@authorized
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle messages in command mode."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
-    user_id = update.effective_user.id
-    if user_id in command_mode_users:
-        command = update.message.text
-        if command.lower() == 'exit':
-            command_mode_users.remove(user_id)
-            await update.message.reply_text("Exited command mode.")
-            return
-        
-        await _execute_and_reply(update, context, command)
+    # A bare 'exit' is caught by its own regex handler before this one,
+    # so only the execute path remains
+    if context.user_data.get('cmd_mode'):
+        await _execute_and_reply(update, context, update.message.text)
     else:
         # If not in command mode and message is not a command, show unknown command message
         if not update.message.text.startswith('/'):
             await update.message.reply_text(UNKNOWN_COMMAND_MESSAGE)
 
+@authorized
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle unknown commands."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text(UNKNOWN_COMMAND_MESSAGE)
 
+async def unauthorized_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tell users outside ALLOWED_USERS that the bot is closed to them."""
+    await update.message.reply_text(_UNAUTH)
+
+# At most this many shell commands run at once; the rest queue up so a
+# burst of /exec calls cannot exhaust FDs or memory on the host
+_EXEC_SEM = asyncio.Semaphore(4)
+
+# Keep at most this much of a command's output; bounds the response
+# building below to constant work however much the command printed
+_MAX_OUTPUT = 1 << 20
+
+def _truncate_output(raw):
+    """Decode captured output, truncating anything past _MAX_OUTPUT."""
+    text = raw[:_MAX_OUTPUT].decode(errors='replace')
+    if len(raw) > _MAX_OUTPUT:
+        text += "\n[output truncated]"
+    return text
+
 async def _execute_and_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str):
     """Execute a command and send the response."""
     start_time = time.time()
     try:
         # Get current directory from context or use root
         current_dir = context.user_data.get('current_dir', '/')
-        
-        # Change to the selected directory before executing command
-        os.chdir(current_dir)
-        
-        # Execute the command
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
+
+        if _EXEC_SEM.locked():
+            await update.message.reply_text("⏳ Command queued, waiting for a free slot...")
+
+        async with _EXEC_SEM:
+            # Execute the command without blocking the event loop; passing
+            # cwd= replaces the old process-global os.chdir, which raced
+            # between concurrently running handlers
+            proc = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=current_dir
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
+
         # Calculate execution time
         execution_time = time.time() - start_time
-        
-        if result.returncode == 0:
+
+        # Silent successes (rm, systemctl restart, ...) get a one-line
+        # ack instead of the full header block. PTB 20.7 predates the
+        # reactions API, so a minimal message is the cheapest option.
+        if proc.returncode == 0 and not stdout.strip():
+            await update.message.reply_text(f"✅ Done in {execution_time:.2f} seconds (no output)")
+            return
+
+        if proc.returncode == 0:
             response = (
                 f"✅ Command executed successfully in {execution_time:.2f} seconds\n"
                 f"📁 Current directory: {current_dir}\n\n"
-                f"{result.stdout}"
+                f"{_truncate_output(stdout)}"
             )
         else:
             response = (
                 f"❌ Command failed with error in {execution_time:.2f} seconds\n"
                 f"📁 Current directory: {current_dir}\n\n"
-                f"{result.stderr}"
+                f"{_truncate_output(stderr)}"
             )
-        
-        # Split response if it's too long
+
+        # Long outputs go up as a single document instead of a chain of
+        # sequential 4000-char messages (one round-trip instead of N)
         if len(response) > 4000:
-            for i in range(0, len(response), 4000):
-                await update.message.reply_text(response[i:i+4000])
+            output_buffer = io.BytesIO(response.encode())
+            await update.message.reply_document(
+                document=output_buffer,
+                filename="output.txt",
+                caption=response.split('\n\n')[0]
+            )
         else:
             await update.message.reply_text(response)
-            
-    except subprocess.TimeoutExpired:
+
+    except asyncio.TimeoutError:
         execution_time = time.time() - start_time
         await update.message.reply_text(f"❌ Command execution timed out after {execution_time:.2f} seconds.")
     except Exception as e:
         execution_time = time.time() - start_time
         await update.message.reply_text(f"❌ Error executing command in {execution_time:.2f} seconds: {str(e)}")
 
-async def dir_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show directory contents with navigation buttons."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
-    # Get current directory from context or use root
-    current_dir = context.user_data.get('current_dir', '/')
-    
-    # Get directory contents
-    ls_result = subprocess.run(
-        f"ls -la {current_dir}",
-        shell=True,
-        capture_output=True,
-        text=True
-    )
-    
-    # Create keyboard buttons
+def _render_dir(target_dir):
+    """Build the listing text and navigation keyboard for a directory."""
+    listing_lines = []
     keyboard = []
     current_row = []
-    
-    # Get directories and files
-    entries = os.listdir(current_dir)
-    for entry in entries:
-        if len(current_row) == 2:  # 2 buttons per row
-            keyboard.append(current_row)
-            current_row = []
-        
-        # Skip . and .. directories
-        if entry in ['.', '..']:
-            continue
-            
-        # Check if it's a directory
-        full_path = os.path.join(current_dir, entry)
-        if os.path.isdir(full_path):
-            current_row.append(InlineKeyboardButton(f"📁 {entry}", callback_data=f"dir_{full_path}"))
-    
+    # One scandir pass supplies both the listing and the buttons:
+    # DirEntry carries the type from readdir and caches stat results
+    with os.scandir(target_dir) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            listing_lines.append(f"{stat.filemode(st.st_mode)} {st.st_size:>10} {entry.name}")
+            if entry.is_dir(follow_symlinks=False):
+                if len(current_row) == 2:  # 2 buttons per row
+                    keyboard.append(current_row)
+                    current_row = []
+                current_row.append(InlineKeyboardButton(f"📁 {entry.name}", callback_data=f"dir_{entry.path}"))
+
     # Add remaining buttons
     if current_row:
         keyboard.append(current_row)
-    
+
     # Add STOP SELECTING button
     keyboard.append([InlineKeyboardButton("🛑 STOP SELECTING", callback_data="stop_dir")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Send message with directory contents and buttons
-    await update.message.reply_text(
-        f"📁 Current directory: {current_dir}\n\n"
+
+    listing = "\n".join(listing_lines)
+    text = (
+        f"📁 Current directory: {target_dir}\n\n"
         f"Directory contents:\n"
-        f"```\n{ls_result.stdout}\n```",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+        f"```\n{listing}\n```"
     )
+    return text, InlineKeyboardMarkup(keyboard)
+
+@authorized
+async def dir_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show directory contents with navigation buttons."""
+    # Get current directory from context or use root
+    current_dir = context.user_data.get('current_dir', '/')
+
+    text, reply_markup = _render_dir(current_dir)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def dir_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle directory navigation button presses."""
@@ -369,69 +453,36 @@ async def dir_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Save selected directory in user context
     context.user_data['current_dir'] = target_dir
-    
-    # Get directory contents
-    ls_result = subprocess.run(
-        f"ls -la {target_dir}",
-        shell=True,
-        capture_output=True,
-        text=True
-    )
-    
-    # Create keyboard buttons
-    keyboard = []
-    current_row = []
-    
-    # Get directories and files
-    entries = os.listdir(target_dir)
-    for entry in entries:
-        if len(current_row) == 2:  # 2 buttons per row
-            keyboard.append(current_row)
-            current_row = []
-        
-        # Skip . and .. directories
-        if entry in ['.', '..']:
-            continue
-            
-        # Check if it's a directory
-        full_path = os.path.join(target_dir, entry)
-        if os.path.isdir(full_path):
-            current_row.append(InlineKeyboardButton(f"📁 {entry}", callback_data=f"dir_{full_path}"))
-    
-    # Add remaining buttons
-    if current_row:
-        keyboard.append(current_row)
-    
-    # Add STOP SELECTING button
-    keyboard.append([InlineKeyboardButton("🛑 STOP SELECTING", callback_data="stop_dir")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Update message with new directory contents and buttons
-    await query.edit_message_text(
-        f"📁 Current directory: {target_dir}\n\n"
-        f"Directory contents:\n"
-        f"```\n{ls_result.stdout}\n```",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
+
+    text, reply_markup = _render_dir(target_dir)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check for updates and notify users if available."""
     try:
         # Get repository information
-        repo = git.Repo('/opt/gfp-pckmgr')
+        repo = _get_repo()
         current_commit = repo.head.commit
-        
+        current_sha = current_commit.hexsha
+
         # Determine active branch
         try:
             branch = repo.active_branch.name
         except:
             branch = 'main'  # Default fallback
-        
-        # Fetch updates
-        repo.remotes.origin.fetch()
-        
+
+        # One ls-remote round-trip answers "did the remote move?" without
+        # transferring any objects; skip the fetch when it did not
+        ls_output = await asyncio.to_thread(repo.git.ls_remote, '--heads', 'origin', branch)
+        if ls_output and ls_output.split()[0] == current_sha:
+            await update.message.reply_text("✅ Bot is up to date!")
+            return
+
+        # The ls-remote just proved the remote moved, so bypass the TTL -
+        # reporting from refs a previous fetch left behind could claim
+        # "up to date" or offer a stale commit
+        await _fetch_if_stale(repo, force=True)
+
         # Verify branch exists
         if f'origin/{branch}' not in repo.references:
             available_branches = []
@@ -448,14 +499,7 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
         remote_commit = repo.remotes.origin.refs[branch].commit
         
         # Check if there are new commits
-        if current_commit != remote_commit.hexsha:
-            # Create keyboard with update buttons
-            keyboard = [
-                [InlineKeyboardButton("🔄 Update Now", callback_data="update_confirm")],
-                [InlineKeyboardButton("❌ Cancel Update", callback_data="update_cancel")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+        if current_sha != remote_commit.hexsha:
             # Get commit information
             commit_message = remote_commit.message.split('\n')[0]
             commit_author = remote_commit.author.name
@@ -472,14 +516,14 @@ async def check_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Store current commit in context
             context.bot_data['pending_update'] = {
-                'old_commit': current_commit,
+                'old_commit': current_sha,
                 'new_commit': remote_commit.hexsha,
                 'branch': branch
             }
             
             await update.message.reply_text(
                 message,
-                reply_markup=reply_markup,
+                reply_markup=UPDATE_CONFIRM_KEYBOARD,
                 parse_mode='Markdown'
             )
         else:
@@ -492,7 +536,7 @@ async def send_startup_notification(context: ContextTypes.DEFAULT_TYPE):
     """Send startup notification to all allowed users."""
     try:
         # Get repository information
-        repo = git.Repo('/opt/gfp-pckmgr')
+        repo = _get_repo()
         current_commit = repo.head.commit
         
         message = (
@@ -504,21 +548,23 @@ async def send_startup_notification(context: ContextTypes.DEFAULT_TYPE):
             f"*Date:* {current_commit.committed_datetime.strftime('%Y-%m-%d %H:%M:%S')}"
         )
         
-        # Send notification to all allowed users
-        for user_id in ALLOWED_USERS:
+        # Send notification to all allowed users concurrently
+        async def _send(user_id):
             try:
-                logger.info(f"Sending startup notification to user {user_id}")
+                logger.info("Sending startup notification to user %s", user_id)
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=message,
                     parse_mode='Markdown'
                 )
-                logger.info(f"Startup notification sent to user {user_id}")
+                logger.info("Startup notification sent to user %s", user_id)
             except Exception as e:
-                logger.error(f"Failed to send startup notification to user {user_id}: {str(e)}")
-                
+                logger.error("Failed to send startup notification to user %s: %s", user_id, e)
+
+        await asyncio.gather(*(_send(user_id) for user_id in ALLOWED_USERS))
+
     except Exception as e:
-        logger.error(f"Error sending startup notification: {str(e)}")
+        logger.error("Error sending startup notification: %s", e)
 
 async def handle_update_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle update confirmation button presses."""
@@ -532,73 +578,89 @@ async def handle_update_button(update: Update, context: ContextTypes.DEFAULT_TYP
     if query.data == "update_confirm":
         try:
             # Get repository
-            repo = git.Repo('/opt/gfp-pckmgr')
+            repo = _get_repo()
             
             # Get update info from context
             update_info = context.bot_data['pending_update']
             branch = update_info['branch']
             
             # Backup local changes
-            backup_dir = os.path.join('/opt/gfp-pckmgr', 'backup')
+            backup_dir = os.path.join(REPO_PATH, 'backup')
             os.makedirs(backup_dir, exist_ok=True)
             
             for file in ['check_updates.py', 'gfp_pckmgr.py']:
-                src = os.path.join('/opt/gfp-pckmgr', file)
+                src = os.path.join(REPO_PATH, file)
                 if os.path.exists(src):
                     dst = os.path.join(backup_dir, f"{file}.bak.{int(time.time())}")
-                    shutil.copy2(src, dst)
-                    logger.info(f"Backed up {file} to {dst}")
+                    await asyncio.to_thread(shutil.copy2, src, dst)
+                    logger.info("Backed up %s to %s", file, dst)
             
-            # Reset to remote branch
-            logger.info(f"Resetting to origin/{branch}")
-            repo.git.reset('--hard', f'origin/{branch}')
+            # Reset to remote branch, off the event loop
+            logger.info("Resetting to origin/%s", branch)
+            await asyncio.to_thread(repo.git.reset, '--hard', f'origin/{branch}')
             
+            # One diff over the update answers both questions below:
+            # whether to reinstall dependencies and whether to restart
+            changed_files = set((await asyncio.to_thread(
+                repo.git.diff, '--name-only', 'HEAD@{1}', 'HEAD'
+            )).splitlines())
+
             # Install new dependencies if requirements.txt changed
-            if 'requirements.txt' in [item.a_path for item in repo.index.diff('HEAD~1')]:
-                subprocess.run(['pip3', 'install', '-r', 'requirements.txt'], check=True)
-            
+            if 'requirements.txt' in changed_files:
+                pip_proc = await asyncio.create_subprocess_exec(
+                    'pip3', 'install', '-r', 'requirements.txt',
+                    cwd=REPO_PATH
+                )
+                if await pip_proc.wait() != 0:
+                    raise RuntimeError("pip3 install failed")
+
+            # Only restart when files the services actually run were updated
+            if not changed_files & RESTART_FILES:
+                logger.info("Update touched no service files (%s), skipping restart", changed_files)
+                await query.edit_message_text(
+                    "✅ Update completed successfully!\n"
+                    "No service files changed, restart not required."
+                )
+                return
+
             # Send success message before restart
             await query.edit_message_text(
                 "✅ Update completed successfully!\n"
                 "The bot will restart momentarily."
             )
-            
+
             # Create restart trigger file
-            restart_file = '/opt/gfp-pckmgr/.restart_trigger'
+            restart_file = os.path.join(REPO_PATH, '.restart_trigger')
             with open(restart_file, 'w') as f:
                 f.write(str(int(time.time())))
-            
+
             # Exit the bot process
             os._exit(0)
             
         except Exception as e:
-            logger.error(f"Error during update: {str(e)}")
+            logger.error("Error during update: %s", e)
             await query.edit_message_text(f"❌ Error during update: {str(e)}")
 
+@authorized
 async def version_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show current and available versions with MD5 hashes."""
-    if update.effective_user.id not in ALLOWED_USERS:
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     try:
         # Get local repository
-        repo = git.Repo('/opt/gfp-pckmgr')
+        repo = _get_repo()
         
         # Get current version info
         current_commit = repo.head.commit
         current_hash = hashlib.md5(str(current_commit).encode()).hexdigest()
         
-        # Get file hashes
+        # Get file hashes (cached; only rehashed when the file changes)
         file_hashes = {}
         for file in ['gfp_pckmgr.py', 'check_updates.py']:
-            file_path = os.path.join('/opt/gfp-pckmgr', file)
+            file_path = os.path.join(REPO_PATH, file)
             if os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    file_hashes[file] = hashlib.md5(f.read()).hexdigest()
+                file_hashes[file] = await asyncio.to_thread(_file_md5, file_path)
         
-        # Get remote repository info
-        repo.remotes.origin.fetch()
+        # Get remote repository info; run the fetch off the event loop
+        await _fetch_if_stale(repo)
         
         # Determine active branch
         try:
@@ -639,12 +701,8 @@ async def version_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             available_version = "\n✅ You are running the latest version!"
         
-        # Create keyboard with update button if update is available
-        keyboard = []
-        if current_commit.hexsha != remote_commit.hexsha:
-            keyboard.append([InlineKeyboardButton("🔄 Update Now", callback_data="update_confirm")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+        # Attach the update button only when an update is available
+        reply_markup = UPDATE_ONLY_KEYBOARD if current_commit.hexsha != remote_commit.hexsha else None
         
         # Send version information
         await update.message.reply_text(
@@ -654,84 +712,90 @@ async def version_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
     except Exception as e:
-        logger.error(f"Error getting version information: {str(e)}")
+        logger.error("Error getting version information: %s", e)
         await update.message.reply_text(f"❌ Error getting version information: {str(e)}")
 
 async def check_pending_updates(context: ContextTypes.DEFAULT_TYPE):
     """Check for pending updates and notify users."""
     try:
-        update_file = os.path.join('/opt/gfp-pckmgr', '.update_available')
-        logger.info(f"Checking for update notification file at {update_file}")
-        
-        if os.path.exists(update_file):
-            logger.info("Update notification file found")
-            try:
-                with open(update_file, 'r') as f:
-                    content = f.read()
-                    logger.info(f"Update file content: {content}")
-                    update_info = eval(content)  # Be careful with eval in production!
-                
-                # Create keyboard with update buttons
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Update Now", callback_data="update_confirm")],
-                    [InlineKeyboardButton("❌ Cancel Update", callback_data="update_cancel")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Send update notification
-                message = (
-                    "🔄 *New Update Available!*\n\n"
-                    f"*Commit:* {update_info['message']}\n"
-                    f"*Author:* {update_info['author']}\n"
-                    f"*Date:* {update_info['date']}\n"
-                    f"*Branch:* {update_info['branch']}\n"
-                    f"*Old Commit:* {update_info['old_commit'][:7]}\n"
-                    f"*New Commit:* {update_info['new_commit'][:7]}\n\n"
-                    "Would you like to update now?"
-                )
-                
-                # Store update info in context
-                context.bot_data['pending_update'] = update_info
-                
-                # Send notification to all allowed users
-                for user_id in ALLOWED_USERS:
-                    try:
-                        logger.info(f"Sending update notification to user {user_id}")
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=message,
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                        logger.info(f"Update notification sent to user {user_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to send update notification to user {user_id}: {str(e)}")
-                
-                # Remove update file
+        # The common case every 30 s is "no file": keep it to one syscall
+        # and no log formatting
+        try:
+            os.stat(UPDATE_FILE)
+        except FileNotFoundError:
+            logger.debug("No update notification file found")
+            return
+
+        logger.info("Update notification file found")
+        try:
+            with open(UPDATE_FILE, 'r') as f:
+                content = f.read()
+                logger.info("Update file content: %s", content)
+                update_info = json.loads(content)
+
+            # Send update notification
+            message = UPDATE_NOTIFICATION_TEMPLATE.format(
+                message=update_info['message'],
+                author=update_info['author'],
+                date=update_info['date'],
+                branch=update_info['branch'],
+                old_commit=update_info['old_commit'][:7],
+                new_commit=update_info['new_commit'][:7]
+            )
+
+            # Store update info in context
+            context.bot_data['pending_update'] = update_info
+
+            # Send notification to all allowed users concurrently
+            async def _send(user_id):
                 try:
-                    os.remove(update_file)
-                    logger.info("Update notification file removed")
+                    logger.info("Sending update notification to user %s", user_id)
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text=message,
+                        reply_markup=UPDATE_CONFIRM_KEYBOARD,
+                        parse_mode='Markdown'
+                    )
+                    logger.info("Update notification sent to user %s", user_id)
                 except Exception as e:
-                    logger.error(f"Failed to remove update notification file: {str(e)}")
-                
+                    logger.error("Failed to send update notification to user %s: %s", user_id, e)
+
+            await asyncio.gather(*(_send(user_id) for user_id in ALLOWED_USERS))
+
+            # Remove update file
+            try:
+                os.remove(UPDATE_FILE)
+                logger.info("Update notification file removed")
             except Exception as e:
-                logger.error(f"Error processing update notification file: {str(e)}")
-        else:
-            logger.info("No update notification file found")
-            
+                logger.error("Failed to remove update notification file: %s", e)
+
+        except Exception as e:
+            logger.error("Error processing update notification file: %s", e)
     except Exception as e:
-        logger.error(f"Error checking pending updates: {str(e)}")
+        logger.error("Error checking pending updates: %s", e)
 
 def main():
     """Start the bot."""
+    # Telegram allows one getUpdates consumer per token; a second poller
+    # puts both into an endless 409-retry loop, so take a token-scoped
+    # lock and bail out fast if another instance already holds it. The
+    # fd stays open (and the lock held) for the life of the process.
+    lock_path = f"/tmp/gfp-pckmgr-{hashlib.sha1(BOT_TOKEN.encode()).hexdigest()[:12]}.lock"
+    lock_fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.error("Another bot instance already holds %s, exiting", lock_path)
+        sys.exit(1)
+
     # Clean up restart trigger file if it exists
-    restart_file = '/opt/gfp-pckmgr/.restart_trigger'
+    restart_file = os.path.join(REPO_PATH, '.restart_trigger')
     if os.path.exists(restart_file):
         try:
             os.remove(restart_file)
             logger.info("Cleaned up restart trigger file")
         except Exception as e:
-            logger.error(f"Error cleaning up restart trigger file: {str(e)}")
+            logger.error("Error cleaning up restart trigger file: %s", e)
     
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN not found in environment variables")
@@ -741,31 +805,66 @@ def main():
         logger.error("No ALLOWED_USERS specified in environment variables")
         return
     
-    logger.info(f"Starting bot with {len(ALLOWED_USERS)} allowed users")
-    
-    # Create the Application and pass it your bot's token
-    application = Application.builder().token(BOT_TOKEN).build()
+    logger.info("Starting bot with %s allowed users", len(ALLOWED_USERS))
+    
+    # Create the Application and pass it your bot's token.
+    # Outbound sends and getUpdates polling get separate connection pools
+    # so a stalled notification fan-out cannot starve polling (or vice versa)
+    send_request = HTTPXRequest(connection_pool_size=32, pool_timeout=5.0)
+    poll_request = HTTPXRequest(connection_pool_size=4, pool_timeout=1.0)
+    # Throttle outbound calls to Telegram's documented limits so the
+    # concurrent notification fan-out cannot trigger 429 retry storms
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60
+    )
+    # Dispatch updates concurrently - the handlers were made
+    # non-blocking for exactly this, and _EXEC_SEM bounds how many
+    # shell commands the concurrency can put in flight at once
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(send_request)
+        .get_updates_request(poll_request)
+        .rate_limiter(rate_limiter)
+        .concurrent_updates(True)
+        .build()
+    )
+
+    # Reject unauthorized updates in PTB's filter layer so no handler
+    # coroutine is even scheduled for them; the @authorized decorator
+    # stays as defence in depth
+    allowed = filters.User(user_id=ALLOWED_USERS)
 
     # Add command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("exec", execute_command))
-    application.add_handler(CommandHandler("cmd_mode", cmd_mode))
-    application.add_handler(CommandHandler("exit", exit_command))
-    application.add_handler(CommandHandler("load_journal", load_journal))
-    application.add_handler(CommandHandler("dir", dir_command))
-    application.add_handler(CommandHandler("update", check_updates))
-    application.add_handler(CommandHandler("version", version_command))
-    
+    application.add_handler(CommandHandler("start", start, filters=allowed))
+    application.add_handler(CommandHandler("help", help_command, filters=allowed))
+    application.add_handler(CommandHandler("exec", execute_command, filters=allowed))
+    application.add_handler(CommandHandler("cmd_mode", cmd_mode, filters=allowed))
+    application.add_handler(CommandHandler("exit", exit_command, filters=allowed))
+    application.add_handler(CommandHandler("load_journal", load_journal, filters=allowed))
+    application.add_handler(CommandHandler("dir", dir_command, filters=allowed))
+    application.add_handler(CommandHandler("update", check_updates, filters=allowed))
+    application.add_handler(CommandHandler("version", version_command, filters=allowed))
+
     # Add callback query handlers
     application.add_handler(CallbackQueryHandler(dir_button, pattern="^dir_|stop_dir$"))
     application.add_handler(CallbackQueryHandler(handle_update_button, pattern="^update_"))
-    
+
+    # A bare 'exit' leaves command mode without touching the generic
+    # text path; must be registered before handle_message
+    application.add_handler(MessageHandler(allowed & filters.Regex(r'(?i)^exit$'), exit_command))
+
     # Add message handler for command mode
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
+    application.add_handler(MessageHandler(allowed & filters.TEXT & ~filters.COMMAND, handle_message))
+
     # Add handler for unknown commands
-    application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    application.add_handler(MessageHandler(allowed & filters.COMMAND, unknown_command))
+
+    # Everyone else gets the standing rejection
+    application.add_handler(MessageHandler(~allowed, unauthorized_reply))
 
     # Add job queue for checking updates
     job_queue = application.job_queue
@@ -778,9 +877,37 @@ def main():
     else:
         logger.error("JobQueue not available. Update notifications will not be sent automatically.")
 
-    # Start the Bot
+    # When WEBHOOK_URL is set Telegram pushes updates to us and the
+    # polling loop (and its baseline traffic) disappears entirely. The
+    # BOT_WEBHOOK_* names stay clear of the updater's WEBHOOK_* settings,
+    # which configure its GitHub push listener.
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        logger.info("Starting bot webhook at %s", webhook_url)
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('BOT_WEBHOOK_PORT', '8443')),
+            secret_token=os.getenv('BOT_WEBHOOK_SECRET') or None,
+            url_path=BOT_TOKEN,
+            webhook_url=webhook_url,
+            allowed_updates=["message", "callback_query"]
+        )
+        return
+
+    # Start the Bot. Long-poll getUpdates: Telegram holds the connection
+    # open up to 50 s and answers the moment an update arrives, instead
+    # of one empty HTTPS exchange per second; retry bootstrap forever so
+    # a network blip at boot doesn't kill the service
     logger.info("Starting bot polling...")
-    application.run_polling()
+    application.run_polling(
+        timeout=50,
+        poll_interval=0,
+        bootstrap_retries=-1,
+        # Only the update kinds we register handlers for; everything
+        # else (edits, channel posts, member events, ...) is wasted
+        # bandwidth and parsing on every poll
+        allowed_updates=["message", "callback_query"]
+    )
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file